@@ -7,9 +7,18 @@ Streamlit app: Grade Bot — Login via Credentials Sheet (Student ID + Access Co
 - Supports upload OR cloud link (SharePoint/OneDrive/Dropbox/GDrive).
 """
 from __future__ import annotations
+import functools
+import hashlib
 import io
+import tempfile
 from typing import Dict, List, Optional, Tuple
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
 import streamlit as st
 import requests
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
@@ -45,102 +54,172 @@ GRADE_STANDARD_COLUMNS = [
     "secret",
 ]
 
+GRADE_STR_COLUMNS = ["student id", "first name", "last name", "course", "term", "assessment", "secret"]
+GRADE_NUM_COLUMNS = ["score", "out of", "weight"]
+
 CRED_REQUIRED = ["student id", "access code"]
+CRED_REQ_SET = frozenset(CRED_REQUIRED)
+
+# Inverted once at import so canonical_name is a single dict lookup.
+SYNONYM_TO_CANONICAL: Dict[str, str] = {
+    s: standard for standard, syns in DEFAULT_SYNONYMS.items() for s in (standard, *syns)
+}
 
 def canonical_name(col: str, custom_map: Dict[str, str]) -> Optional[str]:
     c = str(col).strip().lower()
-    if c in custom_map:
-        return custom_map[c]
-    for standard, syns in DEFAULT_SYNONYMS.items():
-        if c == standard or c in syns:
-            return standard
-    return None
-
-def looks_like_credentials(df: pd.DataFrame, custom_map: Dict[str, str]) -> bool:
-    mapped = set()
-    for c in df.columns:
-        cn = canonical_name(c, custom_map)
-        if cn:
-            mapped.add(cn)
-    return all(req in mapped for req in CRED_REQUIRED)
+    return custom_map.get(c) or SYNONYM_TO_CANONICAL.get(c)
 
-@st.cache_data(show_spinner=False)
-def parse_workbook(file_bytes: bytes) -> Tuple[pd.DataFrame, pd.DataFrame, List[str], str]:
-    xl = pd.ExcelFile(io.BytesIO(file_bytes))
+def looks_like_credentials(columns, custom_map: Dict[str, str]) -> bool:
+    mapped = {canonical_name(c, custom_map) for c in columns}
+    return CRED_REQ_SET.issubset(mapped)
+
+def _open_workbook(file_bytes: bytes):
+    # Prefer calamine; otherwise stream through openpyxl's read-only mode,
+    # which skips the full in-memory workbook object model.
+    if CalamineWorkbook is not None:
+        wb = CalamineWorkbook.from_filelike(io.BytesIO(file_bytes))
+
+        def _rows(name: str):
+            sheet = wb.get_sheet_by_name(name)
+            # iter_rows() panics on blank tabs, and a pyo3 PanicException
+            # is a BaseException no except-Exception handler would catch.
+            if sheet.total_height == 0:
+                return iter(())
+            return sheet.iter_rows()
+
+        return wb.sheet_names, _rows
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    return wb.sheetnames, lambda name: wb[name].iter_rows(values_only=True)
+
+@st.cache_resource(show_spinner=False, hash_funcs={bytes: lambda _: 0})
+def parse_workbook(file_hash: str, file_bytes: bytes) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, str], Dict[str, pd.DataFrame], List[str], str]:
+    # file_hash is the cache key; the bytes themselves are never re-hashed.
+    # One workbook open, then SAX-style row streaming: cells flow straight
+    # into per-column buffers instead of a full-sheet DataFrame first.
+    sheet_names, iter_sheet_rows = _open_workbook(file_bytes)
+    sheet_lookup = {name.strip().lower(): name for name in sheet_names}
 
     custom_map: Dict[str, str] = {}
-    if any(name.strip().lower() == "_aliases" for name in xl.sheet_names):
-        ali = pd.read_excel(io.BytesIO(file_bytes), sheet_name="_aliases")
-        if {c.strip().lower() for c in ali.columns} >= {"key", "value"}:
-            for _, row in ali.iterrows():
-                k = str(row["key"]).strip().lower()
-                v = str(row["value"]).strip().lower()
-                custom_map[v] = k
+    alias_sheet = sheet_lookup.get("_aliases")
+    if alias_sheet is not None:
+        alias_rows = iter_sheet_rows(alias_sheet)
+        header = [str(h).strip().lower() for h in next(alias_rows, [])]
+        if {"key", "value"} <= set(header):
+            ki, vi = header.index("key"), header.index("value")
+            for row in alias_rows:
+                if len(row) > ki and len(row) > vi:
+                    custom_map[str(row[vi]).strip().lower()] = str(row[ki]).strip().lower()
+
+    def _stream_sheet(name: str) -> Dict[str, list]:
+        rows = iter_sheet_rows(name)
+        header = next(rows, None)
+        if header is None:
+            return {}
+        col_idx: Dict[str, int] = {}
+        for i, h in enumerate(header):
+            can = canonical_name(h, custom_map)
+            if can and can not in col_idx:
+                col_idx[can] = i
+        # Projection and row filtering happen during the streaming pass:
+        # only canonical columns are buffered, and rows without a student
+        # id never get materialized.
+        buffers: Dict[str, list] = {can: [] for can in col_idx}
+        sid_i = col_idx.get("student id")
+        for row in rows:
+            if sid_i is not None:
+                sid = row[sid_i] if sid_i < len(row) else None
+                if sid is None or sid == "":
+                    continue
+            for can, i in col_idx.items():
+                v = row[i] if i < len(row) else None
+                if v == "":
+                    v = None
+                elif isinstance(v, float) and v.is_integer():
+                    # calamine yields whole-number cells as floats; fold them
+                    # back to ints so ids stringify as "1001", not "1001.0".
+                    v = int(v)
+                buffers[can].append(v)
+        return buffers
+
+    sheets = {
+        name: _stream_sheet(name)
+        for name in sheet_names
+        if name != alias_sheet
+    }
 
     creds_name = None
-    for name in xl.sheet_names:
+    for name in sheets:
         low = name.strip().lower()
         if low in {"credentials", "login"}:
             creds_name = name
             break
     if creds_name is None:
-        for name in xl.sheet_names:
-            if name.strip().lower() == "_aliases":
-                continue
-            df_try = pd.read_excel(io.BytesIO(file_bytes), sheet_name=name)
-            if looks_like_credentials(df_try, custom_map):
+        for name, buffers in sheets.items():
+            if looks_like_credentials(buffers, custom_map):
                 creds_name = name
                 break
 
     creds_df = pd.DataFrame(columns=["student id", "access code"])
-    grade_frames: List[pd.DataFrame] = []
+    # One set of workbook-wide column buffers: sheets extend them in place
+    # and the grades frame is constructed exactly once, with no concat.
+    grade_cols: Dict[str, list] = {c: [] for c in GRADE_STANDARD_COLUMNS}
+    sheet_col: List[str] = []
     used_grade_sheets: List[str] = []
 
-    for name in xl.sheet_names:
-        low = name.strip().lower()
-        if low == "_aliases":
-            continue
-        df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=name)
-
-        colmap = {}
-        for c in df.columns:
-            can = canonical_name(c, custom_map)
-            if can:
-                colmap[c] = can
-        df = df.rename(columns=colmap)
-
+    for name, buffers in sheets.items():
+        # _stream_sheet already emitted canonical column names.
         if creds_name and name == creds_name:
-            tmp = df.copy()
-            for req in CRED_REQUIRED:
-                if req not in tmp.columns:
-                    tmp[req] = pd.NA
-            tmp = tmp[CRED_REQUIRED].dropna(subset=["student id"]).copy()
-            tmp["student id"] = tmp["student id"].astype(str).str.strip()
-            tmp["access code"] = tmp["access code"].astype(str).str.strip()
-            creds_df = tmp
+            # Without a student id column no row can authenticate, so the
+            # credentials frame stays empty (matching the old dropna result).
+            if "student id" in buffers:
+                n = len(buffers["student id"])
+                tmp = pd.DataFrame({c: buffers.get(c, [None] * n) for c in CRED_REQUIRED})
+                tmp = tmp.dropna(subset=["student id"])
+                tmp[CRED_REQUIRED] = tmp[CRED_REQUIRED].astype("string[pyarrow]").apply(lambda s: s.str.strip())
+                creds_df = tmp
         else:
-            for col in GRADE_STANDARD_COLUMNS:
-                if col not in df.columns:
-                    df[col] = pd.NA
-            df = df.dropna(subset=["student id"]).copy()
-            df["student id"] = df["student id"].astype(str).str.strip()
-            for c in ["first name", "last name", "course", "term", "assessment", "secret"]:
-                df[c] = df[c].astype(str).str.strip()
-            for c in ["score", "out of", "weight"]:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
-            df.loc[df["out of"].isna(), "out of"] = 100
-            df["_sheet"] = name
             used_grade_sheets.append(name)
-            grade_frames.append(df[GRADE_STANDARD_COLUMNS + ["_sheet"]])
+            # Sheets without a student id column contribute no usable rows.
+            n = len(buffers.get("student id", []))
+            if n:
+                for c in GRADE_STANDARD_COLUMNS:
+                    grade_cols[c].extend(buffers.get(c, [None] * n))
+                sheet_col.extend([name] * n)
+
+    grades_df = pd.DataFrame(grade_cols)
+    grades_df["_sheet"] = sheet_col
+    # Arrow-backed strings keep cells in contiguous buffers instead of one
+    # Python object per cell, so the strip is a vectorized kernel — and the
+    # whole normalization now runs once over the full frame, not per sheet.
+    grades_df[GRADE_STR_COLUMNS] = grades_df[GRADE_STR_COLUMNS].astype("string[pyarrow]").apply(lambda s: s.str.strip())
+    grades_df[GRADE_NUM_COLUMNS] = grades_df[GRADE_NUM_COLUMNS].apply(pd.to_numeric, errors="coerce", downcast="float")
+    grades_df.loc[grades_df["out of"].isna(), "out of"] = 100
+
+    # Dictionary-encode the low-cardinality columns: int codes instead of a
+    # Python string per cell, which also speeds up the course groupby.
+    for c in ("course", "term", "assessment", "first name", "last name", "_sheet"):
+        grades_df[c] = grades_df[c].astype("category")
+
+    # Normalize once at ingest so each login is a hash lookup, not a frame scan.
+    # Rows without an access code can never authenticate.
+    valid_creds = creds_df.dropna(subset=["access code"])
+    creds_lookup = dict(zip(valid_creds["student id"].str.lower(), valid_creds["access code"]))
+    norm_sid = grades_df["student id"].astype(str).str.lower()
+    grades_by_sid = {k: grades_df.loc[idx] for k, idx in norm_sid.groupby(norm_sid).groups.items()}
+
+    return grades_df, creds_df, creds_lookup, grades_by_sid, used_grade_sheets, creds_name or "(auto-detected/none)"
+
+MAX_WORKBOOK_BYTES = 100 << 20  # refuse cloud downloads beyond 100 MB
 
-    grades_df = pd.concat(grade_frames, ignore_index=True) if grade_frames else pd.DataFrame(columns=GRADE_STANDARD_COLUMNS + ["_sheet"])
-    return grades_df, creds_df, used_grade_sheets, creds_name or "(auto-detected/none)"
+_SP_HOSTS = ("sharepoint.com", "1drv.ms")
 
+@functools.lru_cache(maxsize=128)
 def _coerce_download_url(u: str) -> str:
     try:
         pr = urlparse(u)
         q = parse_qs(pr.query)
-        if pr.netloc.endswith("sharepoint.com") or pr.netloc.endswith("1drv.ms"):
+        if pr.netloc.endswith(_SP_HOSTS):
             if "download" not in q:
                 q["download"] = ["1"]
         if pr.netloc.endswith("dropbox.com"):
@@ -150,29 +229,59 @@ def _coerce_download_url(u: str) -> str:
     except Exception:
         return u
 
-def compute_course_total(q: pd.DataFrame) -> float:
-    if q.empty:
-        return float("nan")
-    if q["weight"].notna().any():
-        w = q["weight"].fillna(0)
-        if w.sum() == 0:
-            denom = q["out of"].fillna(100).sum()
-            return (q["score"].fillna(0).sum() / denom) * 100 if denom else float("nan")
-        contrib = (q["score"].fillna(0) / q["out of"].replace(0, pd.NA).fillna(100)) * w
-        return (contrib.sum() / w.sum()) * 100
-    denom = q["out of"].fillna(100).sum()
-    return (q["score"].fillna(0).sum() / denom) * 100 if denom else float("nan")
-
 def summarize_by_course(rows: pd.DataFrame) -> pd.DataFrame:
-    out = []
-    for course, sub in rows.groupby(rows["course"].fillna("")).groups.items():
-        part = rows.loc[sub]
-        pct = compute_course_total(part)
-        out.append({"Course": course or "(Unspecified)", "Overall %": pct, "Assessments": len(part)})
-    if not out:
+    if rows.empty:
         return pd.DataFrame(columns=["Course", "Overall %", "Assessments"])
-    df = pd.DataFrame(out).sort_values("Course").reset_index(drop=True)
-    return df
+    # Fill on a plain string view: fillna("") on the categorical itself
+    # raises when "" is not already a category.
+    course = rows["course"].astype("string").fillna("").astype(str)
+    r = pd.DataFrame({
+        "course": course.where(course != "", "(Unspecified)"),
+        "_s": rows["score"].fillna(0).astype(float),
+        "_oo": rows["out of"].replace(0, pd.NA).fillna(100).astype(float),
+        "_den": rows["out of"].fillna(100).astype(float),
+        "_w": rows["weight"].fillna(0).astype(float),
+    })
+    r["_contrib"] = r["_s"] / r["_oo"] * r["_w"]
+    agg = r.groupby("course", sort=True).agg(
+        contrib=("_contrib", "sum"),
+        wsum=("_w", "sum"),
+        ssum=("_s", "sum"),
+        denom=("_den", "sum"),
+        n=("_s", "size"),
+    )
+    # One Cython-backed groupby instead of a Python call per course.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.where(
+            agg["wsum"] > 0,
+            agg["contrib"] / agg["wsum"] * 100,
+            np.where(agg["denom"] > 0, agg["ssum"] / agg["denom"] * 100, np.nan),
+        )
+    return pd.DataFrame({"Course": agg.index, "Overall %": pct, "Assessments": agg["n"].to_numpy()}).reset_index(drop=True)
+
+@st.cache_data(show_spinner=False)
+def student_view(workbook_digest: str, sid_norm: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # workbook_digest keys the cache; the data itself comes from session state.
+    grades = st.session_state["grade_df"]
+    rows = st.session_state["grades_by_sid"].get(sid_norm, grades.iloc[:0])
+    summary = summarize_by_course(rows)
+    # Copy only the columns that get rendered, not names/secret/ids.
+    details = rows[["course", "term", "assessment", "score", "out of", "weight", "_sheet"]].copy()
+    s = np.nan_to_num(details["score"].to_numpy(dtype=np.float64, na_value=np.nan), nan=0.0)
+    o = details["out of"].to_numpy(dtype=np.float64, na_value=np.nan)
+    details["Percent"] = s / np.where(np.isnan(o) | (o == 0), 100.0, o) * 100
+    details = details[[
+        "course", "term", "assessment", "score", "out of", "Percent", "weight", "_sheet"
+    ]].rename(columns={
+        "course": "Course",
+        "term": "Term",
+        "assessment": "Assessment",
+        "score": "Score",
+        "out of": "Out of",
+        "weight": "Weight %",
+        "_sheet": "Sheet"
+    })
+    return summary, details.sort_values(["Course", "Assessment"])
 
 st.sidebar.header("Teacher setup")
 st.sidebar.write("Upload your Excel OR paste a cloud link. The app finds a credentials sheet (Student ID + Access Code) and uses other sheets for grades.")
@@ -183,13 +292,20 @@ fetch_btn = st.sidebar.button("Fetch from cloud link")
 if "grade_df" not in st.session_state:
     st.session_state["grade_df"] = None
     st.session_state["creds_df"] = None
+    st.session_state["creds_lookup"] = None
+    st.session_state["grades_by_sid"] = None
     st.session_state["creds_sheet_name"] = None
+    st.session_state["workbook_digest"] = None
 
 def _load_bytes(file_bytes: bytes):
-    grades, creds, grade_sheets, creds_name = parse_workbook(file_bytes)
+    file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    grades, creds, creds_lookup, grades_by_sid, grade_sheets, creds_name = parse_workbook(file_hash, file_bytes)
     st.session_state["grade_df"] = grades
     st.session_state["creds_df"] = creds
+    st.session_state["creds_lookup"] = creds_lookup
+    st.session_state["grades_by_sid"] = grades_by_sid
     st.session_state["creds_sheet_name"] = creds_name
+    st.session_state["workbook_digest"] = file_hash
     st.sidebar.success(f"Loaded {len(grades):,} grade rows from {len(grade_sheets)} sheet(s). Credentials sheet: {creds_name}")
     if grade_sheets:
         st.sidebar.caption("Grade sheets: " + ", ".join(grade_sheets))
@@ -200,15 +316,30 @@ if workbook is not None:
     except Exception as e:
         st.sidebar.error(f"Problem reading workbook: {e}")
 
+def _download_workbook(url: str) -> bytes:
+    # Stream into a spooled temp file so a large workbook never sits in
+    # memory twice (socket buffer + full payload) during the download.
+    buf = tempfile.SpooledTemporaryFile(max_size=8 << 20)
+    with requests.get(url, timeout=30, stream=True, headers={"Accept-Encoding": "gzip"}) as r:
+        r.raise_for_status()
+        total = 0
+        # iter_content applies any Content-Encoding, unlike raw socket reads.
+        for chunk in r.iter_content(1 << 20):
+            total += len(chunk)
+            if total > MAX_WORKBOOK_BYTES:
+                raise ValueError(f"workbook larger than {MAX_WORKBOOK_BYTES >> 20} MB")
+            buf.write(chunk)
+    buf.seek(0)
+    return buf.read()
+
 if fetch_btn and cloud_url:
     try:
         direct = _coerce_download_url(cloud_url.strip())
         with st.sidebar.status("Fetching workbook...", expanded=False):
-            r = requests.get(direct, timeout=30)
-        if r.status_code != 200:
-            st.sidebar.error(f"Could not download file (HTTP {r.status_code}). If this is SharePoint/OneDrive, set link permissions to 'Anyone with the link' and try again. Also try adding &download=1 to the link.")
-        else:
-            _load_bytes(r.content)
+            data = _download_workbook(direct)
+        _load_bytes(data)
+    except requests.HTTPError as e:
+        st.sidebar.error(f"Could not download file (HTTP {e.response.status_code}). If this is SharePoint/OneDrive, set link permissions to 'Anyone with the link' and try again. Also try adding &download=1 to the link.")
     except Exception as e:
         st.sidebar.error(f"Problem fetching workbook: {e}")
 
@@ -223,43 +354,28 @@ show = st.button("Log in and show my grades")
 
 if show:
     grades = st.session_state.get("grade_df")
-    creds = st.session_state.get("creds_df")
+    creds_lookup = st.session_state.get("creds_lookup")
+    grades_by_sid = st.session_state.get("grades_by_sid")
 
-    if grades is None or creds is None or creds.empty:
+    if grades is None or not creds_lookup:
         st.error("Workbook not loaded or credentials sheet missing. Ensure a sheet named 'credentials'/'login' exists, or the first sheet contains 'Student ID' and 'Access Code'.")
     else:
         sid_norm = str(sid).strip().lower()
         code_norm = str(code).strip()
-        creds_cmp = creds.copy()
-        creds_cmp["student id"] = creds_cmp["student id"].astype(str).str.strip().str.lower()
-        creds_cmp["access code"] = creds_cmp["access code"].astype(str).str.strip()
 
-        match = creds_cmp[(creds_cmp["student id"] == sid_norm) & (creds_cmp["access code"] == code_norm)]
-        if match.empty:
+        if creds_lookup.get(sid_norm) != code_norm:
             st.warning("Invalid Student ID or Access Code.")
         else:
-            rows = grades[grades["student id"].astype(str).str.strip().str.lower() == sid_norm]
-            if rows.empty:
+            if sid_norm not in grades_by_sid:
                 st.info("Login OK, but no grade rows were found for this Student ID.")
             else:
-                summary = summarize_by_course(rows)
+                summary, details = student_view(st.session_state["workbook_digest"], sid_norm)
                 if not summary.empty:
                     st.markdown("### Course summary")
                     st.dataframe(summary, use_container_width=True)
 
                 st.markdown("### Assessment details")
-                details = rows.copy()
-                details["Percent"] = (details["score"].fillna(0) / details["out of"].replace(0, pd.NA).fillna(100)) * 100
-                details = details[[
-                    "course", "term", "assessment", "score", "out of", "Percent", "weight", "_sheet"
-                ]].rename(columns={
-                    "course": "Course",
-                    "term": "Term",
-                    "assessment": "Assessment",
-                    "score": "Score",
-                    "out of": "Out of",
-                    "weight": "Weight %",
-                    "_sheet": "Sheet"
-                })
-                st.dataframe(details.sort_values(["Course", "Assessment"]), use_container_width=True)
+                # Hand Streamlit a ready Arrow table so it skips its own
+                # pandas-to-Arrow conversion on every render.
+                st.dataframe(pa.Table.from_pandas(details, preserve_index=False), use_container_width=True)
                 st.caption("If any assessment is missing or looks off, please contact your instructor.")